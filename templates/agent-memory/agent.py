@@ -13,10 +13,16 @@ Handles context limits, state persistence, and memory retrieval.
 
 import os
 import json
-from typing import List, Dict, Any, Optional
+import re
+import functools
+import bisect
+import itertools
+import mmap
+from typing import List, Dict, Any, Optional, Deque
 from datetime import datetime
+from collections import deque
 from pathlib import Path
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from openai import OpenAI
 from dotenv import load_dotenv
 import tiktoken
@@ -30,6 +36,20 @@ client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 # TOKEN COUNTING - Essential for context window management
 # ============================================================================
 
+@functools.lru_cache(maxsize=8)
+def _get_encoding(model: str = "gpt-4") -> tiktoken.Encoding:
+    """
+    Get the tiktoken encoding for a model, built once and shared.
+    
+    Building an encoding costs far more than using it. Cache it or pay
+    that cost on every message of every turn.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")  # Fallback
+
+
 def count_tokens(text: str, model: str = "gpt-4") -> int:
     """
     Count tokens in text using tiktoken.
@@ -37,38 +57,70 @@ def count_tokens(text: str, model: str = "gpt-4") -> int:
     Context windows are measured in tokens, not characters.
     Always count tokens, never guess.
     """
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")  # Fallback
-    
-    return len(encoding.encode(text))
+    return len(_get_encoding(model).encode(text))
 
 
 def count_messages_tokens(messages: List[Dict[str, str]], model: str = "gpt-4") -> int:
     """Count total tokens in a message list"""
-    # Rough approximation: messages have overhead beyond just content
-    total = 0
-    for msg in messages:
-        total += count_tokens(msg.get("content", ""), model)
-        total += 4  # Message overhead (role, formatting, etc.)
-    return total
+    # Rough approximation: messages have overhead beyond just content.
+    # encode_batch tokenizes in parallel native threads - one call, not N.
+    enc = _get_encoding(model)
+    encoded = enc.encode_batch([msg.get("content", "") for msg in messages])
+    overhead = 4 * len(messages)  # Message overhead (role, formatting, etc.)
+    return sum(map(len, encoded)) + overhead
 
 
 # ============================================================================
 # MEMORY STORAGE
 # ============================================================================
 
-@dataclass
+@dataclass(slots=True)  # One instance per fact - no per-instance __dict__
 class MemoryEntry:
     """A single long-term memory fact"""
     key: str
     value: str
     timestamp: str
     importance: int = 5  # 1-10 scale
+    compressed: Optional[str] = None  # Dense key=value form for prompts
+    token_count: int = 0  # Tokens in prompt_form(), computed once on add
     
     def to_dict(self) -> Dict[str, Any]:
-        return asdict(self)
+        # Flat fields: a literal beats asdict()'s recursive deep copy
+        return {
+            "key": self.key,
+            "value": self.value,
+            "timestamp": self.timestamp,
+            "importance": self.importance,
+            "compressed": self.compressed,
+            "token_count": self.token_count,
+        }
+    
+    def prompt_form(self) -> str:
+        """The form this fact takes in the system prompt"""
+        return self.compressed or f"{self.key}={self.value}"
+
+
+def _tail_lines(path: Path, n: int) -> List[bytes]:
+    """
+    Return the last n non-empty lines of a file.
+    
+    The conversation log is append-only and grows forever, but load only
+    wants the tail. Memory-map it and scan backwards for newlines: the OS
+    pages in the end of the file, the rest is never read or copied.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []  # mmap can't map an empty file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            lines = []
+            end = len(mm)
+            while end > 0 and len(lines) < n:
+                start = mm.rfind(b"\n", 0, end) + 1
+                if start < end:
+                    lines.append(mm[start:end])
+                end = start - 1
+            lines.reverse()
+            return lines
 
 
 class Memory:
@@ -83,7 +135,8 @@ class Memory:
         self,
         user_id: str,
         max_context_tokens: int = 4000,
-        memory_dir: str = "./memory_data"
+        memory_dir: str = "./memory_data",
+        max_messages: int = 20
     ):
         self.user_id = user_id
         self.max_context_tokens = max_context_tokens
@@ -91,41 +144,114 @@ class Memory:
         self.memory_dir.mkdir(exist_ok=True)
         
         # Short-term memory (conversation history)
-        self.conversation: List[Dict[str, str]] = []
+        # Each message carries its own token_count, computed once on add.
+        # Bounded deque: O(1) append, oldest message evicted automatically.
+        self.conversation: Deque[Dict[str, Any]] = deque(maxlen=max_messages)
+        self._total_tokens = 0  # Running sum of token_count over conversation
         
         # Long-term memory (persistent facts)
         self.facts: Dict[str, MemoryEntry] = {}
+        self._facts_dirty = False  # Set when facts change, cleared on save
         
         # Working memory (current session state)
         self.working_state: Dict[str, Any] = {}
+        
+        # Size of the last context built by get_conversation_context
+        self.last_context_tokens = 0
     
     # ========================================================================
     # PERSISTENCE
     # ========================================================================
     
-    def _get_memory_file(self) -> Path:
-        """Get the memory file path for this user"""
+    def _get_facts_file(self) -> Path:
+        """Get the long-term facts file path for this user"""
+        return self.memory_dir / f"{self.user_id}_facts.jsonl"
+    
+    def _get_conversation_file(self) -> Path:
+        """Get the append-only conversation log path for this user"""
+        return self.memory_dir / f"{self.user_id}_conv.jsonl"
+    
+    def _get_legacy_file(self) -> Path:
+        """Single-file format used before facts and conversation were split"""
         return self.memory_dir / f"{self.user_id}_memory.json"
     
-    def save(self):
+    def _migrate_legacy_file(self, legacy_file: Path):
+        """
+        One-time import of {user_id}_memory.json into the JSONL files.
+        
+        Writes the new files only; load() then reads them as usual, which
+        also fills in token counts. The old file is left as a backup.
+        """
+        with open(legacy_file, 'r') as f:
+            data = json.load(f)
+        
+        header = {
+            "user_id": self.user_id,
+            "updated_at": data.get("updated_at") or datetime.now().isoformat(),
+        }
+        with open(self._get_facts_file(), 'w') as f:
+            f.write(json.dumps(header) + "\n")
+            for fact in data.get("facts", {}).values():
+                f.write(json.dumps(fact) + "\n")
+        
+        with open(self._get_conversation_file(), 'w') as f:
+            for msg in data.get("last_conversation", []):
+                f.write(json.dumps(msg) + "\n")
+        
+        print(f"📦 Migrated {legacy_file.name} to the JSONL format")
+    
+    def _append_message(self, msg: Dict[str, Any]):
+        """Append one message to the conversation log"""
+        with open(self._get_conversation_file(), 'a') as f:
+            f.write(json.dumps(msg) + "\n")
+    
+    def _rewrite_conversation_log(self):
+        """
+        Replace the conversation log with the current history.
+        
+        Only needed when history is rewritten (compression), not on
+        every turn. Same write-and-rename as save().
+        """
+        path = self._get_conversation_file()
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text("".join(json.dumps(m) + "\n" for m in self.conversation))
+        os.replace(tmp, path)
+    
+    def save(self, timestamp: Optional[str] = None):
         """
         Save memory to disk.
         
+        Storage is split by how often it changes:
+        - Conversation: append-only JSONL, written by add_message
+        - Facts: JSONL (header line, then one fact per line), rewritten
+          only when a fact changed
+        
+        A turn that learned nothing new costs zero writes here.
+        
         In production:
         - Use a proper database
         - Add file locking for concurrent access
         - Encrypt sensitive data
-        - Handle write failures gracefully
         """
-        memory_data = {
+        if not self._facts_dirty:
+            return
+        
+        header = {
             "user_id": self.user_id,
-            "updated_at": datetime.now().isoformat(),
-            "facts": {k: v.to_dict() for k, v in self.facts.items()},
-            "last_conversation": self.conversation[-20:],  # Keep recent messages only
+            "updated_at": timestamp or datetime.now().isoformat(),
         }
         
-        with open(self._get_memory_file(), 'w') as f:
-            json.dump(memory_data, f, indent=2)
+        # One fact per line so load() can stream entries instead of
+        # parsing the whole file into memory at once. Write-and-rename:
+        # a crash mid-write leaves the old file intact.
+        path = self._get_facts_file()
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(header) + "\n")
+            for fact in self.facts.values():
+                f.write(json.dumps(fact.to_dict()) + "\n")
+        os.replace(tmp, path)
+        self._facts_dirty = False
         
         print(f"💾 Memory saved for user {self.user_id}")
     
@@ -133,26 +259,64 @@ class Memory:
     def load(cls, user_id: str, memory_dir: str = "./memory_data") -> "Memory":
         """Load memory from disk or create new"""
         memory = cls(user_id, memory_dir=memory_dir)
-        memory_file = memory._get_memory_file()
+        facts_file = memory._get_facts_file()
+        conversation_file = memory._get_conversation_file()
+        
+        # Memory saved by the old single-file format: convert it once
+        legacy_file = memory._get_legacy_file()
+        if not facts_file.exists() and not conversation_file.exists() and legacy_file.exists():
+            memory._migrate_legacy_file(legacy_file)
         
-        if memory_file.exists():
-            with open(memory_file, 'r') as f:
-                data = json.load(f)
+        if not facts_file.exists() and not conversation_file.exists():
+            print(f"📝 Created new memory for user {user_id}")
+            return memory
+        
+        if facts_file.exists():
+            # Load long-term facts, one line at a time - peak memory is
+            # one entry, not the whole file's object graph
+            with open(facts_file, 'r') as f:
+                f.readline()  # Header: user_id, updated_at
+                for line in f:
+                    entry = MemoryEntry(**json.loads(line))
+                    memory.facts[entry.key] = entry
             
-            # Load long-term facts
-            memory.facts = {
-                k: MemoryEntry(**v) 
-                for k, v in data.get("facts", {}).items()
-            }
+            # Facts saved before token counts existed: one batch pass
+            uncounted = [e for e in memory.facts.values() if not e.token_count]
+            if uncounted:
+                encoded = _get_encoding().encode_batch([e.prompt_form() for e in uncounted])
+                for entry, ids in zip(uncounted, encoded):
+                    entry.token_count = len(ids)
+        
+        if conversation_file.exists():
+            # Load recent conversation - only the tail of the log is kept
+            for line in _tail_lines(conversation_file, memory.conversation.maxlen):
+                try:
+                    memory.conversation.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A crash mid-append leaves a torn line. Lose that one
+                    # message, not the whole history.
+                    print(f"⚠️  Skipped unreadable line in {conversation_file.name}")
             
-            # Load recent conversation
-            memory.conversation = data.get("last_conversation", [])
+            # Terminate a torn last line so the next append starts clean
+            # instead of gluing onto it
+            with open(conversation_file, 'rb+') as f:
+                if f.seek(0, os.SEEK_END) > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")
             
-            print(f"📂 Loaded memory for user {user_id}")
-            print(f"   - {len(memory.facts)} facts")
-            print(f"   - {len(memory.conversation)} messages")
-        else:
-            print(f"📝 Created new memory for user {user_id}")
+            # Logs written before token counts were persisted need one
+            # batch tokenization pass. After that, metering is free.
+            missing = [m for m in memory.conversation if "token_count" not in m]
+            if missing:
+                encoded = _get_encoding().encode_batch([m["content"] for m in missing])
+                for msg, ids in zip(missing, encoded):
+                    msg["token_count"] = len(ids)
+            memory._total_tokens = sum(m["token_count"] for m in memory.conversation)
+        
+        print(f"📂 Loaded memory for user {user_id}")
+        print(f"   - {len(memory.facts)} facts")
+        print(f"   - {len(memory.conversation)} messages")
         
         return memory
     
@@ -160,13 +324,91 @@ class Memory:
     # CONVERSATION MANAGEMENT
     # ========================================================================
     
-    def add_message(self, role: str, content: str):
-        """Add a message to conversation history"""
-        self.conversation.append({
+    def add_message(self, role: str, content: str, timestamp: Optional[str] = None):
+        """
+        Add a message to conversation history.
+        
+        Tokenize once here and store the count on the message.
+        Every later budget check reads the stored count instead of
+        re-running the tokenizer over the whole history.
+        
+        Pass timestamp to reuse one clock read across a whole turn.
+        """
+        timestamp = timestamp or datetime.now().isoformat()
+        token_count = len(_get_encoding().encode(content))
+        msg = {
             "role": role,
             "content": content,
-            "timestamp": datetime.now().isoformat()
-        })
+            "timestamp": timestamp,
+            "token_count": token_count
+        }
+        if len(self.conversation) == self.conversation.maxlen:
+            # append() is about to evict the oldest message
+            self._total_tokens -= self.conversation[0]["token_count"]
+        self.conversation.append(msg)
+        self._total_tokens += token_count
+        self._append_message(msg)
+        self._maybe_compress(timestamp)
+    
+    def _maybe_compress(self, timestamp: str):
+        """
+        Summarize older history once it crosses 75% of the context budget.
+        
+        Truncation silently forgets. Summarization keeps the facts and
+        drops the wording. Runs once per threshold crossing, not per turn,
+        and the summary shrinks every prompt that follows.
+        
+        The most recent user message and everything after it are kept
+        verbatim - the model must always see the current turn as written.
+        """
+        if self._total_tokens <= 0.75 * self.max_context_tokens:
+            return
+        
+        # Pivot on the most recent user message
+        history = list(self.conversation)
+        pivot = next(
+            (i for i in range(len(history) - 1, -1, -1)
+             if history[i]["role"] == "user"),
+            0
+        )
+        hist, keep = history[:pivot], history[pivot:]
+        if len(hist) < 2:
+            # Nothing worth compressing (at most one earlier summary)
+            return
+        
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in hist)
+        try:
+            response = client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "Summarize the following conversation into concise, structured facts. "
+                                   "Keep names, preferences, decisions, and open questions. Drop pleasantries."
+                    },
+                    {"role": "user", "content": transcript}
+                ],
+                temperature=0
+            )
+            summary = response.choices[0].message.content
+        except Exception as e:
+            # Compression is an optimization. If it fails, context
+            # building still truncates to fit - degrade, don't crash.
+            print(f"⚠️  History compression failed: {e}")
+            return
+        
+        content = f"Summary of earlier conversation:\n{summary}"
+        summary_msg = {
+            "role": "system",
+            "content": content,
+            "timestamp": timestamp,
+            "token_count": len(_get_encoding().encode(content))
+        }
+        self.conversation = deque([summary_msg, *keep], maxlen=self.conversation.maxlen)
+        self._total_tokens = sum(m["token_count"] for m in self.conversation)
+        self._rewrite_conversation_log()
+        
+        print(f"🗜️  Compressed {len(hist)} messages into a summary")
     
     def get_conversation_context(
         self,
@@ -198,19 +440,19 @@ class Memory:
         used_tokens = count_tokens(system_content)
         remaining_tokens = self.max_context_tokens - used_tokens - 500  # Reserve for response
         
-        # Add conversation messages (newest first, then reverse)
-        conversation_to_include = []
-        for msg in reversed(self.conversation):
-            msg_tokens = count_tokens(msg["content"])
-            if used_tokens + msg_tokens > remaining_tokens:
-                # Would exceed limit - stop here
-                break
-            
-            conversation_to_include.insert(0, {
-                "role": msg["role"],
-                "content": msg["content"]
-            })
-            used_tokens += msg_tokens
+        # Add the most recent messages that fit. Token counts were stored
+        # on add, so this is a prefix sum over newest-first counts plus a
+        # binary search for the cutoff - no tokenizer calls, no inserts.
+        cumulative = list(itertools.accumulate(
+            msg["token_count"] for msg in reversed(self.conversation)
+        ))
+        fit = bisect.bisect_right(cumulative, remaining_tokens - used_tokens)
+        conversation_to_include = [
+            {"role": msg["role"], "content": msg["content"]}
+            for msg in itertools.islice(self.conversation, len(self.conversation) - fit, None)
+        ]
+        if fit:
+            used_tokens += cumulative[fit - 1]
         
         # If we couldn't fit all messages, add a summary of what was cut
         if len(conversation_to_include) < len(self.conversation):
@@ -223,13 +465,22 @@ class Memory:
         
         messages.extend(conversation_to_include)
         
+        # Record the size so callers can log it without re-tokenizing
+        self.last_context_tokens = used_tokens + 4 * len(messages)  # Same overhead as count_messages_tokens
+        
         return messages
     
     # ========================================================================
     # LONG-TERM MEMORY (FACTS)
     # ========================================================================
     
-    def add_fact(self, key: str, value: str, importance: int = 5):
+    def add_fact(
+        self,
+        key: str,
+        value: str,
+        importance: int = 5,
+        timestamp: Optional[str] = None
+    ):
         """
         Add or update a long-term memory fact.
         
@@ -237,13 +488,43 @@ class Memory:
         - User preferences
         - Important context
         - Learned behaviors
+        
+        Long values are compressed once here into dense key=value pairs.
+        One small LLM call per fact, paid back on every turn the fact
+        rides along in the system prompt. The original value is kept.
         """
-        self.facts[key] = MemoryEntry(
+        entry = MemoryEntry(
             key=key,
             value=value,
-            timestamp=datetime.now().isoformat(),
-            importance=importance
+            timestamp=timestamp or datetime.now().isoformat(),
+            importance=importance,
+            compressed=self._compress_fact(value) if len(value) > 60 else None
         )
+        entry.token_count = len(_get_encoding().encode(entry.prompt_form()))
+        self.facts[key] = entry
+        self._facts_dirty = True
+    
+    def _compress_fact(self, value: str) -> Optional[str]:
+        """Rewrite a verbose fact as terse key=value pairs, or None on failure"""
+        try:
+            response = client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "Rewrite the user's statement as terse snake_case key=value pairs "
+                                   "separated by '; '. Keep every fact, drop all prose. "
+                                   "Example: 'I prefer short answers' -> answer_style=concise"
+                    },
+                    {"role": "user", "content": value}
+                ],
+                temperature=0
+            )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            # The verbose form still works - just costs more tokens
+            print(f"⚠️  Fact compression failed: {e}")
+            return None
     
     def get_fact(self, key: str) -> Optional[str]:
         """Retrieve a specific fact"""
@@ -255,18 +536,27 @@ class Memory:
         if not self.facts:
             return ""
         
-        # Sort by importance (most important first)
-        sorted_facts = sorted(
-            self.facts.values(),
-            key=lambda x: x.importance,
-            reverse=True
-        )
-        
-        facts_text = "Important context from previous conversations:\n"
-        for fact in sorted_facts[:10]:  # Limit to top 10 facts
-            facts_text += f"- {fact.key}: {fact.value}\n"
+        # Pack by importance within a token budget, not a fixed count:
+        # one long fact shouldn't crowd out the budget, ten short ones
+        # shouldn't be cut off just for being ten. Counts were stored on add.
+        budget = int(0.2 * self.max_context_tokens)
+        top_facts = []
+        tokens_so_far = 0
+        for fact in sorted(self.facts.values(), key=lambda x: x.importance, reverse=True):
+            if tokens_so_far + fact.token_count > budget:
+                continue  # Too big for what's left - a smaller one may fit
+            top_facts.append(fact)
+            tokens_so_far += fact.token_count
+        
+        if not top_facts:
+            return ""
         
-        return facts_text
+        # One dense line instead of a bulleted list: the model reads
+        # key=value pairs fine, and punctuation and prose cost tokens
+        return (
+            "Important context from previous conversations (key=value):\n"
+            "@CTX " + "; ".join(fact.prompt_form() for fact in top_facts)
+        )
     
     # ========================================================================
     # WORKING MEMORY (TEMPORARY STATE)
@@ -285,6 +575,14 @@ class Memory:
 # STATEFUL AGENT
 # ============================================================================
 
+# All fact triggers in one compiled alternation: a single scan of the
+# message instead of one substring search per phrase
+_FACT_PATTERN = re.compile(
+    r"\b(?:(?P<preference>i prefer|i like)\b|my name is\s+(?P<name>\w+))",
+    re.IGNORECASE
+)
+
+
 class StatefulAgent:
     """
     An agent with memory.
@@ -317,13 +615,17 @@ Be helpful, concise, and build on previous context."""
         print(f"User: {user_message}")
         print(f"{'='*60}")
         
+        # One clock read per turn, shared by every write below
+        now = datetime.now()
+        now_iso = now.isoformat()
+        
         # Add user message to memory
-        self.memory.add_message("user", user_message)
+        self.memory.add_message("user", user_message, timestamp=now_iso)
         
         # Get conversation context with memory
         messages = self.memory.get_conversation_context(self.system_prompt)
         
-        print(f"\n📊 Context: {count_messages_tokens(messages)} tokens")
+        print(f"\n📊 Context: {self.memory.last_context_tokens} tokens")
         print(f"   - {len(messages)} messages")
         print(f"   - {len(self.memory.facts)} long-term facts")
         
@@ -337,14 +639,14 @@ Be helpful, concise, and build on previous context."""
         assistant_message = response.choices[0].message.content
         
         # Add response to memory
-        self.memory.add_message("assistant", assistant_message)
+        self.memory.add_message("assistant", assistant_message, timestamp=now_iso)
         
         # Auto-extract and save important facts
         # In production, you'd use a more sophisticated extraction method
-        self._extract_facts(user_message, assistant_message)
+        self._extract_facts(user_message, assistant_message, now)
         
         # Save memory to disk
-        self.memory.save()
+        self.memory.save(timestamp=now_iso)
         
         print(f"\n{'='*60}")
         print(f"Assistant: {assistant_message}")
@@ -352,7 +654,7 @@ Be helpful, concise, and build on previous context."""
         
         return assistant_message
     
-    def _extract_facts(self, user_msg: str, assistant_msg: str):
+    def _extract_facts(self, user_msg: str, assistant_msg: str, now: datetime):
         """
         Simple fact extraction from conversation.
         
@@ -361,21 +663,31 @@ Be helpful, concise, and build on previous context."""
         - Named entity recognition
         - Semantic similarity to detect important info
         """
-        # Simple heuristics for demo purposes
-        user_lower = user_msg.lower()
+        # Simple heuristics for demo purposes - one regex pass finds every trigger
+        is_preference = False
+        name = None
+        for match in _FACT_PATTERN.finditer(user_msg):
+            if match.group("preference"):
+                is_preference = True
+            else:
+                name = match.group("name")
+        
+        now_iso = now.isoformat()
         
         # Detect preferences
-        if "i prefer" in user_lower or "i like" in user_lower:
+        # Microseconds in the key: two preferences in the same second
+        # used to collide and silently overwrite each other
+        if is_preference:
             self.memory.add_fact(
-                f"preference_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+                f"preference_{now.strftime('%Y%m%d_%H%M%S_%f')}",
                 user_msg,
-                importance=7
+                importance=7,
+                timestamp=now_iso
             )
         
         # Detect personal info
-        if "my name is" in user_lower:
-            name = user_msg.split("my name is")[-1].strip().split()[0]
-            self.memory.add_fact("user_name", name, importance=10)
+        if name:
+            self.memory.add_fact("user_name", name, importance=10, timestamp=now_iso)
 
 
 # ============================================================================
@@ -9,16 +9,18 @@ Clear boundaries, explicit communication, no shared state.
 
 import os
 import json
+import re
 import asyncio
 from typing import List, Dict, Any, Optional
 from dataclasses import dataclass
 from enum import Enum
-from openai import OpenAI
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Async client: independent agents overlap their network waits
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 
 # ============================================================================
@@ -56,8 +58,10 @@ class SpecialistAgent:
     def __init__(self, agent_type: AgentType, system_prompt: str):
         self.agent_type = agent_type
         self.system_prompt = system_prompt
+        # The system prompt never changes - build its message once
+        self._system_msg = {"role": "system", "content": system_prompt}
     
-    def run(self, task: str, context: Dict[str, Any] = None) -> AgentResult:
+    async def run(self, task: str, context: Dict[str, Any] = None) -> AgentResult:
         """
         Execute the agent's task.
         
@@ -67,11 +71,11 @@ class SpecialistAgent:
         """
         try:
             messages = [
-                {"role": "system", "content": self.system_prompt},
+                self._system_msg,
                 {"role": "user", "content": self._format_task(task, context)}
             ]
             
-            response = client.chat.completions.create(
+            response = await client.chat.completions.create(
                 model="gpt-4o-mini",
                 messages=messages,
                 temperature=0.7
@@ -99,11 +103,12 @@ class SpecialistAgent:
         if not context:
             return task
         
-        context_str = "\n\nContext from previous agents:\n"
-        for key, value in context.items():
-            context_str += f"\n{key}:\n{value}\n"
+        # Context values can be whole agent outputs - join once
+        # instead of growing a string with +=
+        parts = [task, "\n\nContext from previous agents:\n"]
+        parts.extend(f"\n{key}:\n{value}\n" for key, value in context.items())
         
-        return task + context_str
+        return "".join(parts)
 
 
 # ============================================================================
@@ -179,6 +184,11 @@ class Orchestrator:
     4. Aggregate results into final output
     """
     
+    # Planning keywords, built once - not per task
+    _RESEARCH_KW = frozenset({"research", "find", "information", "facts", "data"})
+    _ANALYSIS_KW = frozenset({"analyze", "insights", "patterns", "why", "compare"})
+    _WRITING_KW = frozenset({"write", "draft", "create", "summarize", "explain"})
+    
     def __init__(self):
         # Initialize all available agents
         self.agents = {
@@ -187,7 +197,7 @@ class Orchestrator:
             AgentType.WRITING: WritingAgent(),
         }
     
-    def run(self, task: str) -> str:
+    async def run(self, task: str) -> str:
         """
         Main orchestrator loop.
         
@@ -210,7 +220,7 @@ class Orchestrator:
         print("ORCHESTRATOR: Executing plan")
         print("="*60)
         
-        results = self._execute_plan(plan)
+        results = await self._execute_plan(plan)
         
         # Step 3: Synthesize final answer
         print("\n" + "="*60)
@@ -231,12 +241,14 @@ class Orchestrator:
         # Simple heuristic-based planning
         # In production, you might use an LLM to generate the plan
         
-        task_lower = task.lower()
+        # Tokenize once, then set lookups. Whole words only: "data"
+        # no longer matches inside "update"
+        words = set(re.findall(r"\w+", task.lower()))
         
         # Determine which agents are needed
-        needs_research = any(word in task_lower for word in ["research", "find", "information", "facts", "data"])
-        needs_analysis = any(word in task_lower for word in ["analyze", "insights", "patterns", "why", "compare"])
-        needs_writing = any(word in task_lower for word in ["write", "draft", "create", "summarize", "explain"])
+        needs_research = not self._RESEARCH_KW.isdisjoint(words)
+        needs_analysis = not self._ANALYSIS_KW.isdisjoint(words)
+        needs_writing = not self._WRITING_KW.isdisjoint(words)
         
         steps = []
         
@@ -270,42 +282,63 @@ class Orchestrator:
         
         return {"steps": steps}
     
-    def _execute_plan(self, plan: Dict[str, Any]) -> Dict[AgentType, AgentResult]:
+    async def _execute_plan(self, plan: Dict[str, Any]) -> Dict[AgentType, AgentResult]:
         """
-        Execute the plan.
+        Execute the plan, running independent steps in parallel.
         
-        For simplicity, this runs sequentially.
-        In production, you'd run independent tasks in parallel.
+        Steps form a DAG through depends_on. Each round runs every step
+        whose dependencies are done, concurrently - wall time is the sum
+        of the slowest step per level, not the sum of all steps.
         """
         results = {}
-        context = {}
+        remaining = list(plan["steps"])
         
-        for step in plan["steps"]:
-            agent_type = step["agent"]
-            task = step["task"]
-            
-            print(f"\n🤖 Running {agent_type.value.upper()} agent...")
-            
-            # Get dependencies from context
-            deps = step.get("depends_on", [])
-            agent_context = {
-                dep.value: results[dep].data 
-                for dep in deps 
-                if dep in results and results[dep].success
-            }
+        while remaining:
+            pending = {step["agent"] for step in remaining}
+            ready = [
+                step for step in remaining
+                if not any(dep in pending for dep in step.get("depends_on", []))
+            ]
+            if not ready:
+                raise ValueError(f"Circular dependencies in plan: {sorted(a.value for a in pending)}")
             
-            # Execute agent
-            result = self.agents[agent_type].run(task, agent_context)
-            results[agent_type] = result
+            level_results = await asyncio.gather(*(self._run_step(step, results) for step in ready))
             
-            if result.success:
-                print(f"✅ {agent_type.value.upper()} completed")
-                print(f"   Tokens used: {result.metadata.get('tokens', 'unknown')}")
-            else:
-                print(f"❌ {agent_type.value.upper()} failed: {result.error}")
+            for step, result in zip(ready, level_results):
+                results[step["agent"]] = result
+            remaining = [step for step in remaining if step not in ready]
         
         return results
     
+    async def _run_step(
+        self,
+        step: Dict[str, Any],
+        results: Dict[AgentType, AgentResult]
+    ) -> AgentResult:
+        """Run one plan step with context from its finished dependencies"""
+        agent_type = step["agent"]
+        
+        print(f"\n🤖 Running {agent_type.value.upper()} agent...")
+        
+        # Get dependencies from context
+        deps = step.get("depends_on", [])
+        agent_context = {
+            dep.value: results[dep].data 
+            for dep in deps 
+            if dep in results and results[dep].success
+        }
+        
+        # Execute agent
+        result = await self.agents[agent_type].run(step["task"], agent_context)
+        
+        if result.success:
+            print(f"✅ {agent_type.value.upper()} completed")
+            print(f"   Tokens used: {result.metadata.get('tokens', 'unknown')}")
+        else:
+            print(f"❌ {agent_type.value.upper()} failed: {result.error}")
+        
+        return result
+    
     def _synthesize_results(self, original_task: str, results: Dict[AgentType, AgentResult]) -> str:
         """
         Combine agent outputs into a coherent final answer.
@@ -344,7 +377,7 @@ class Orchestrator:
 # MAIN
 # ============================================================================
 
-if __name__ == "__main__":
+async def main():
     # Example tasks that benefit from multiple agents
     
     tasks = [
@@ -359,7 +392,7 @@ if __name__ == "__main__":
         print(f"TASK {i}: {task}")
         print("="*60)
         
-        result = orchestrator.run(task)
+        result = await orchestrator.run(task)
         
         print("\n" + "="*60)
         print("FINAL RESULT")
@@ -369,3 +402,9 @@ if __name__ == "__main__":
         
         if i < len(tasks):
             print("\n" + "━"*60 + "\n")
+
+
+if __name__ == "__main__":
+    # One event loop for the whole run - the async client's connections
+    # are bound to the loop that opened them
+    asyncio.run(main())
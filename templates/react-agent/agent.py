@@ -9,21 +9,59 @@ No magic, no frameworks — just a loop that thinks, acts, and learns from resul
 
 import os
 import json
-from typing import Any, Dict, List, Optional
-from openai import OpenAI
+import asyncio
+import hashlib
+import functools
+from collections import OrderedDict
+import logging
+import logging.handlers
+import math
+import operator
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from openai import AsyncOpenAI, Timeout
+from openai.types.chat import ChatCompletionToolParam
 from dotenv import load_dotenv
+import tiktoken
 
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Configure logging - essential for debugging production failures.
+# Records are buffered and written in batches (every 1000 records, on
+# any ERROR, or at exit), so concurrent tool calls don't queue up behind
+# synchronous stdout writes. At WARNING level in production, the info()
+# calls in the loop reduce to an isEnabledFor() check.
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_buffer = logging.handlers.MemoryHandler(
+    capacity=1000,
+    flushLevel=logging.ERROR,
+    target=_log_output
+)
+logging.basicConfig(level=logging.INFO, handlers=[log_buffer])
+logger = logging.getLogger(__name__)
+
+# Initialize OpenAI client (async, so tool calls can overlap)
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    # One client for every call in the process. Its connection pool keeps
+    # connections alive, so iterations skip the TCP+TLS handshake; the
+    # SDK's default pool limits already cover many concurrent agents.
+    # Fail a dead connection in 5s rather than the SDK's 10-minute default.
+    timeout=Timeout(30.0, connect=5.0)
+)
+
+# Reusable JSON codecs. json.dumps() with any non-default option builds a
+# fresh encoder per call; these are built once and shared by every call.
+_json_decoder = json.JSONDecoder()
+_compact_json = json.JSONEncoder(separators=(",", ":")).encode
+_canonical_json = json.JSONEncoder(sort_keys=True, default=str).encode
 
 
 # ============================================================================
 # TOOLS - Define what the agent can do
 # ============================================================================
 
-def get_weather(city: str) -> Dict[str, Any]:
+async def get_weather(city: str) -> Dict[str, Any]:
     """
     Mock weather API. In production, call a real weather service.
     
@@ -45,7 +83,7 @@ def get_weather(city: str) -> Dict[str, Any]:
     return weather_data.get(city, {"temp": 70, "condition": "Unknown", "precipitation": "50%"})
 
 
-def search_web(query: str) -> str:
+async def search_web(query: str) -> str:
     """
     Mock web search. In production, use a real search API.
     
@@ -65,7 +103,14 @@ def search_web(query: str) -> str:
 # TOOL REGISTRY - Map tool names to functions
 # ============================================================================
 
-def tool_executor(tool_name: str, arguments: Dict[str, Any]) -> str:
+# Built once at import, not on every tool call
+_TOOL_REGISTRY: Dict[str, Callable[..., Awaitable[Any]]] = {
+    "get_weather": get_weather,
+    "search_web": search_web,
+}
+
+
+async def tool_executor(tool_name: str, arguments: Dict[str, Any]) -> str:
     """
     Execute a tool by name with given arguments.
     
@@ -74,19 +119,15 @@ def tool_executor(tool_name: str, arguments: Dict[str, Any]) -> str:
     - Error handling at the boundary
     - Return strings (easier for the LLM to process)
     """
-    tools = {
-        "get_weather": get_weather,
-        "search_web": search_web,
-    }
-    
-    if tool_name not in tools:
+    func = _TOOL_REGISTRY.get(tool_name)
+    if func is None:
         return f"Error: Unknown tool '{tool_name}'"
     
     try:
-        result = tools[tool_name](**arguments)
-        # Convert dict results to JSON strings for consistency
+        result = await func(**arguments)
+        # Convert dict results to compact JSON - whitespace is billed tokens
         if isinstance(result, dict):
-            return json.dumps(result, indent=2)
+            return _compact_json(result)
         return str(result)
     except Exception as e:
         # Don't crash. Return the error to the agent.
@@ -98,7 +139,7 @@ def tool_executor(tool_name: str, arguments: Dict[str, Any]) -> str:
 # TOOL SCHEMAS - Tell the LLM what tools exist
 # ============================================================================
 
-TOOLS = [
+TOOLS: List[ChatCompletionToolParam] = [
     {
         "type": "function",
         "function": {
@@ -136,21 +177,342 @@ TOOLS = [
 ]
 
 
+# ============================================================================
+# STREAMING + LLM RESPONSE CACHE - Start tools while the model is still talking
+# ============================================================================
+
+LLM_CACHE_MAX_ENTRIES = 256  # Least recently used entries go first
+
+# Request hash -> (assistant message, tokens it cost), oldest use first.
+# Process-local: swap in Redis or a disk cache if runs should share hits.
+_llm_cache: "OrderedDict[str, Tuple[Dict[str, Any], int]]" = OrderedDict()
+
+# Everything in a request except the messages. Fixed for the whole run,
+# so serialize and hash it once; each call only hashes its messages.
+_REQUEST_OPTIONS: Dict[str, Any] = {
+    "model": "gpt-4o-mini",  # Use gpt-4 for better reasoning
+    "tools": TOOLS,
+    "tool_choice": "auto",  # Let the model decide when to use tools
+}
+_REQUEST_OPTIONS_HASH = hashlib.sha256(_canonical_json(_REQUEST_OPTIONS).encode())
+
+
+def _complete_arguments(buffer: str) -> Optional[Dict[str, Any]]:
+    """Parsed tool arguments if the streamed JSON object is complete, else None"""
+    try:
+        args, _ = _json_decoder.raw_decode(buffer.lstrip())
+    except json.JSONDecodeError:
+        return None
+    return args if isinstance(args, dict) else None
+
+
+def _parse_arguments(raw: str) -> Dict[str, Any]:
+    """Parse a finished arguments string - the model may send "" for no arguments"""
+    return json.loads(raw or "{}")
+
+
+async def stream_chat_completion(
+    messages: List[Dict[str, Any]],
+    dispatch: Callable[[str, Dict[str, Any]], Awaitable[str]],
+    use_cache: bool = True
+) -> Tuple[Dict[str, Any], List["asyncio.Task[str]"]]:
+    """
+    Run one model turn, starting each tool call the moment it's complete.
+    
+    A blocking call waits for the whole completion before any tool runs.
+    Streaming lets the first tool call's network round-trip overlap with
+    the model still generating the second one.
+    
+    Identical requests (model, messages, tools, tool_choice) replay from
+    cache instead of re-billing and re-waiting for every step, unless
+    use_cache is off. The cache keeps the LLM_CACHE_MAX_ENTRIES most
+    recently used responses.
+    
+    Returns the assistant message, ready to append to history, and one
+    task per tool call in call order.
+    """
+    key = None
+    if use_cache:
+        hasher = _REQUEST_OPTIONS_HASH.copy()
+        hasher.update(_canonical_json(messages).encode())
+        key = hasher.hexdigest()
+    
+    cached = _llm_cache.get(key) if key else None
+    if cached is not None:
+        _llm_cache.move_to_end(key)
+        message, tokens = cached
+        logger.info("💾 LLM cache hit - saved %d tokens", tokens)
+        # Parse every call before starting any, so a bad one can't strand
+        # tasks already created for the others
+        parsed = [
+            (tc["function"]["name"], _parse_arguments(tc["function"]["arguments"]))
+            for tc in message.get("tool_calls", [])
+        ]
+        return message, [asyncio.create_task(dispatch(name, args)) for name, args in parsed]
+    
+    content_parts: List[str] = []
+    calls: Dict[int, Dict[str, Any]] = {}  # Stream index -> tool call, wire format
+    tasks_by_index: Dict[int, "asyncio.Task[str]"] = {}
+    usage = None
+    
+    try:
+        stream = await client.chat.completions.create(
+            **_REQUEST_OPTIONS,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        async for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage  # Final chunk, no choices
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            
+            if delta.content:
+                content_parts.append(delta.content)
+            
+            for tc in delta.tool_calls or []:
+                call = calls.setdefault(tc.index, {
+                    "id": "",
+                    "type": "function",
+                    "function": {"name": "", "arguments": ""}
+                })
+                if tc.id:
+                    call["id"] = tc.id
+                if tc.function and tc.function.name:
+                    call["function"]["name"] += tc.function.name
+                if tc.function and tc.function.arguments:
+                    call["function"]["arguments"] += tc.function.arguments
+                
+                # Dispatch as soon as the arguments parse as a full object
+                if tc.index not in tasks_by_index:
+                    args = _complete_arguments(call["function"]["arguments"])
+                    if args is not None:
+                        tasks_by_index[tc.index] = asyncio.create_task(
+                            dispatch(call["function"]["name"], args)
+                        )
+        
+        # Anything the incremental check missed (e.g. empty arguments)
+        for index, call in calls.items():
+            if index not in tasks_by_index:
+                args = _parse_arguments(call["function"]["arguments"])
+                tasks_by_index[index] = asyncio.create_task(dispatch(call["function"]["name"], args))
+    except BaseException:
+        # Don't leave tools running for a turn that never completed
+        for task in tasks_by_index.values():
+            task.cancel()
+        raise
+    
+    message: Dict[str, Any] = {"role": "assistant", "content": "".join(content_parts) or None}
+    if calls:
+        message["tool_calls"] = [calls[i] for i in sorted(calls)]
+    
+    if usage:
+        if key:
+            _llm_cache[key] = (message, usage.total_tokens)
+            _llm_cache.move_to_end(key)
+            if len(_llm_cache) > LLM_CACHE_MAX_ENTRIES:
+                _llm_cache.popitem(last=False)
+        
+        # Confirm the stable prefix is being reused by OpenAI's prompt cache
+        details = usage.prompt_tokens_details
+        if details and details.cached_tokens:
+            logger.info("⚡ Prompt cache: %d/%d input tokens cached", details.cached_tokens, usage.prompt_tokens)
+    
+    return message, [tasks_by_index[i] for i in sorted(tasks_by_index)]
+
+
+# ============================================================================
+# HISTORY COMPACTION - Bound per-iteration prompt size
+# ============================================================================
+
+@functools.lru_cache(maxsize=1)
+def _get_encoding() -> tiktoken.Encoding:
+    """Build the tokenizer once - construction is the expensive part"""
+    try:
+        return tiktoken.encoding_for_model("gpt-4o-mini")
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")  # Older tiktoken
+
+
+@functools.lru_cache(maxsize=4096)
+def _count_tokens(text: str) -> int:
+    """Token count per string, memoized - history is re-measured every iteration"""
+    return len(_get_encoding().encode(text))
+
+
+def _message_tokens(msg: Dict[str, Any]) -> int:
+    """Approximate tokens for one message, including tool call arguments"""
+    tokens = 4  # Role and formatting overhead
+    if msg.get("content"):
+        tokens += _count_tokens(msg["content"])
+    for tc in msg.get("tool_calls", []):
+        tokens += _count_tokens(tc["function"]["name"]) + _count_tokens(tc["function"]["arguments"])
+    return tokens
+
+
+def compact_messages(messages: List[Dict[str, Any]], max_tokens: int = 4096) -> List[Dict[str, Any]]:
+    """
+    Keep the prompt under max_tokens by folding old tool rounds into a summary.
+    
+    Every iteration resends the whole history, so total tokens sent over a
+    run grow quadratically. Once over budget:
+    - Keep the system prompt and the original task
+    - Keep the most recent tool rounds (assistant call + its results) that fit
+    - Fold older rounds into one "Prior tool results summary" message
+    
+    Rounds are never split - the API rejects tool results whose call is gone.
+    Under budget, history is returned untouched so the prompt prefix stays
+    stable for prompt caching.
+    """
+    if sum(_message_tokens(m) for m in messages) <= max_tokens:
+        return messages
+    
+    head, body = messages[:2], messages[2:]
+    
+    # Carry forward the summary from an earlier compaction
+    summary_lines = []
+    if body and body[0]["role"] == "system":
+        summary_lines = body[0]["content"].splitlines()[1:]
+        body = body[1:]
+    
+    # Group into rounds: an assistant message and the tool results after it
+    rounds: List[List[Dict[str, Any]]] = []
+    for msg in body:
+        if msg["role"] == "tool" and rounds:
+            rounds[-1].append(msg)
+        else:
+            rounds.append([msg])
+    
+    # A quarter of the budget for the summary, the rest for recent rounds
+    summary_budget = max_tokens // 4
+    
+    # Newest rounds first, while they fit. The latest always stays.
+    budget = max_tokens - sum(_message_tokens(m) for m in head) - summary_budget
+    kept: List[List[Dict[str, Any]]] = []
+    for rnd in reversed(rounds):
+        cost = sum(_message_tokens(m) for m in rnd)
+        if kept and cost > budget:
+            break
+        kept.insert(0, rnd)
+        budget -= cost
+    
+    # One line per folded tool result, truncated
+    for rnd in rounds[:len(rounds) - len(kept)]:
+        calls = {tc["id"]: tc["function"] for tc in rnd[0].get("tool_calls", [])}
+        for msg in rnd[1:]:
+            fn = calls.get(msg["tool_call_id"], {"name": "tool", "arguments": ""})
+            summary_lines.append(f"- {fn['name']}({fn['arguments']}) -> {msg['content'][:200]}")
+    
+    # The summary is bounded too: newest lines win, the oldest drop off
+    recent_lines = []
+    for line in reversed(summary_lines):
+        summary_budget -= _count_tokens(line)
+        if summary_budget < 0:
+            break
+        recent_lines.append(line)
+    summary_lines = recent_lines[::-1]
+    
+    summary = {
+        "role": "system",
+        "content": "Prior tool results summary:\n" + "\n".join(summary_lines)
+    }
+    return head + [summary] + [m for rnd in kept for m in rnd]
+
+
+# ============================================================================
+# SEMANTIC CACHE - Skip the whole loop for a task already answered
+# ============================================================================
+
+SEMANTIC_CACHE_THRESHOLD = 0.95  # Cosine similarity needed to reuse an answer
+
+# (unit-length task embedding, final answer). A linear scan is fine for
+# hundreds of entries; past that, move to a vector index.
+_semantic_cache: List[Tuple[List[float], str]] = []
+
+
+async def embed_task(task: str) -> List[float]:
+    """Embed a task, normalized so cosine similarity is a dot product"""
+    response = await client.embeddings.create(model="text-embedding-3-small", input=task)
+    vector = response.data[0].embedding
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def semantic_cache_lookup(embedding: List[float]) -> Optional[str]:
+    """Answer to the most similar earlier task, if it's similar enough"""
+    best_answer, best_score = None, SEMANTIC_CACHE_THRESHOLD
+    for cached_embedding, answer in _semantic_cache:
+        score = sum(map(operator.mul, embedding, cached_embedding))
+        if score >= best_score:
+            best_answer, best_score = answer, score
+    return best_answer
+
+
 # ============================================================================
 # AGENT LOOP
 # ============================================================================
 
-def react_agent(task: str, max_iterations: int = 10) -> str:
+# Iteration banner, built once. One log record per iteration, not three.
+_ITERATION_HEADER = "\n" + "=" * 60 + "\nIteration %d/%d\n" + "=" * 60
+
+
+async def run_tool_call(
+    tool_name: str,
+    tool_args: Dict[str, Any],
+    semaphore: asyncio.Semaphore
+) -> str:
+    """Execute one tool call, bounded by the shared semaphore"""
+    logger.info("🔧 Calling %s(%s)", tool_name, tool_args)
+    
+    async with semaphore:
+        result = await tool_executor(tool_name, tool_args)
+    
+    logger.info("📊 Result: %s", result)
+    return result
+
+
+async def react_agent(
+    task: str,
+    max_iterations: int = 10,
+    max_concurrent_tools: int = 10,
+    max_context_tokens: int = 4096,
+    semantic_cache: bool = False,
+    cache_llm_calls: bool = True
+) -> str:
     """
     The ReAct loop. Simple, transparent, reliable.
     
     Parameters:
     - task: What you want the agent to do
     - max_iterations: Safety limit to prevent infinite loops
+    - max_concurrent_tools: Cap on tool calls in flight at once
+    - max_context_tokens: History budget; older tool rounds get summarized
+    - semantic_cache: Reuse the answer to a near-identical earlier task
+      instead of running the loop. Costs one embedding call per task.
+      Leave off when answers go stale (live data) or must be exact.
+    - cache_llm_calls: Replay identical model requests from the in-process
+      LLM cache. Turn off to always hit the API (e.g. sampling variety).
     
     Returns the agent's final answer or an error message.
     """
     
+    # A paraphrase of a task already answered skips every iteration below
+    embedding: Optional[List[float]] = None
+    if semantic_cache:
+        try:
+            embedding = await embed_task(task)
+        except Exception as e:
+            # The cache is an optimization. If embedding fails, run the
+            # loop without it - degrade, don't crash.
+            logger.warning("⚠️  Semantic cache skipped, embedding failed: %s", e)
+        if embedding is not None:
+            cached_answer = semantic_cache_lookup(embedding)
+            if cached_answer is not None:
+                logger.info("🧠 Semantic cache hit - skipped the agent loop")
+                return cached_answer
+    
     # System prompt defines the agent's behavior
     # Be specific. Vague prompts = unpredictable agents.
     system_prompt = """You are a helpful AI agent that can use tools to complete tasks.
@@ -163,76 +525,87 @@ For each step:
 When you have enough information to answer the user's question, respond directly without calling more tools.
 Be concise and helpful."""
 
-    # Conversation history - includes all reasoning and tool results
+    # Conversation history - includes all reasoning and tool results.
+    # Append-only until max_context_tokens is reached. OpenAI caches
+    # prompt prefixes automatically once they pass 1024 tokens, and an
+    # unchanged prefix (system prompt, tools, history so far) is what
+    # it matches on - cached input tokens bill at half price. A
+    # compaction rewrites older messages, so the prefix past the task
+    # changes once each time it runs.
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": task}
     ]
     
+    # Bounds tool fan-out so one response can't flood a downstream API
+    semaphore = asyncio.Semaphore(max_concurrent_tools)
+    
     for iteration in range(max_iterations):
-        print(f"\n{'='*60}")
-        print(f"Iteration {iteration + 1}/{max_iterations}")
-        print(f"{'='*60}")
+        logger.info(_ITERATION_HEADER, iteration + 1, max_iterations)
         
-        # Agent reasons about what to do next
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # Use gpt-4 for better reasoning
-            messages=messages,
-            tools=TOOLS,
-            tool_choice="auto"  # Let the model decide when to use tools
+        # Agent reasons about what to do next. Tool calls start running
+        # while the response is still streaming in.
+        message, tool_tasks = await stream_chat_completion(
+            messages,
+            lambda name, args: run_tool_call(name, args, semaphore),
+            cache_llm_calls
         )
         
-        message = response.choices[0].message
-        
         # Case 1: Agent wants to use a tool
-        if message.tool_calls:
-            print(f"\n🤔 Agent reasoning: Calling tools...")
+        if tool_tasks:
+            logger.info("🤔 Agent reasoning: Calling tools...")
             
-            # Add the assistant's message (with tool calls) to history
-            messages.append({
-                "role": "assistant",
-                "content": message.content,
-                "tool_calls": [
-                    {
-                        "id": tc.id,
-                        "type": "function",
-                        "function": {
-                            "name": tc.function.name,
-                            "arguments": tc.function.arguments
-                        }
-                    }
-                    for tc in message.tool_calls
-                ]
-            })
+            # Add the assistant's message (with tool calls) to history.
+            # Already in wire format - assembled once from the stream,
+            # so there's no per-iteration rebuild of the tool_calls list.
+            messages.append(message)
             
-            # Execute each tool call
-            for tool_call in message.tool_calls:
-                tool_name = tool_call.function.name
-                tool_args = json.loads(tool_call.function.arguments)
-                
-                print(f"🔧 Calling {tool_name}({tool_args})")
-                
-                # Execute the tool
-                result = tool_executor(tool_name, tool_args)
-                print(f"📊 Result: {result}")
-                
-                # Add tool result to conversation history
+            # Tool calls run concurrently. They're independent, so wall
+            # time is the slowest call, not the sum of all calls.
+            results = await asyncio.gather(*tool_tasks)
+            
+            # Add tool results to history in the original call order
+            for tool_call, result in zip(message["tool_calls"], results):
                 messages.append({
                     "role": "tool",
                     "content": result,
-                    "tool_call_id": tool_call.id
+                    "tool_call_id": tool_call["id"]
                 })
+            
+            messages = compact_messages(messages, max_context_tokens)
         
         # Case 2: Agent provides final answer (no tool calls)
         else:
-            print(f"\n✅ Agent final answer:")
-            print(message.content)
-            return message.content
+            logger.info("✅ Agent final answer: %s", message["content"])
+            if embedding is not None:
+                _semantic_cache.append((embedding, message["content"]))
+            return message["content"]
     
     # Hit max iterations without completing
     return f"Error: Agent did not complete task within {max_iterations} iterations"
 
 
+async def react_agent_batch(tasks: List[str], max_concurrency: int = 10) -> List[str]:
+    """
+    Run many independent tasks concurrently, results in input order.
+    
+    Each agent run spends nearly all its time waiting on the network, so
+    N tasks take about as long as the slowest one instead of the sum.
+    max_concurrency caps runs in flight to stay under API rate limits.
+    A failed run returns an error string; it doesn't sink the batch.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    
+    async def run_one(task: str) -> str:
+        async with semaphore:
+            try:
+                return await react_agent(task)
+            except Exception as e:
+                return f"Error: {str(e)}"
+    
+    return await asyncio.gather(*(run_one(task) for task in tasks))
+
+
 # ============================================================================
 # MAIN
 # ============================================================================
@@ -246,8 +619,10 @@ if __name__ == "__main__":
     print("="*60)
     print(f"\nTask: {task}\n")
     
-    result = react_agent(task)
+    result = asyncio.run(react_agent(task))
+    log_buffer.flush()
     
     print("\n" + "="*60)
     print("COMPLETED")
     print("="*60)
+    print(result)
@@ -10,30 +10,62 @@ import os
 import json
 import time
 import random
-from typing import Any, Dict, Optional, Callable
+import asyncio
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Any, Awaitable, Dict, List, Optional, Callable, Tuple
 from dataclasses import dataclass, field
-from datetime import datetime, timedelta
-from openai import OpenAI
+from openai import AsyncOpenAI, Timeout
+from openai.types.chat import ChatCompletionToolParam
 from dotenv import load_dotenv
+import tiktoken
 from tenacity import (
     retry,
     stop_after_attempt,
-    wait_exponential,
+    stop_after_delay,
+    wait_fixed,
+    wait_random_exponential,
     retry_if_exception_type,
     before_sleep_log,
+    RetryCallState,
 )
 import logging
+import logging.handlers
 
 load_dotenv()
 
-# Configure logging - essential for debugging production failures
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Configure logging - essential for debugging production failures.
+# Records are buffered and written in batches (every 1000 records, on
+# any ERROR, or at exit), so concurrent tool calls don't queue up behind
+# synchronous stdout writes. At WARNING level in production, the info()
+# calls in the loop reduce to an isEnabledFor() check.
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_buffer = logging.handlers.MemoryHandler(
+    capacity=1000,
+    flushLevel=logging.ERROR,
+    target=_log_output
 )
+logging.basicConfig(level=logging.INFO, handlers=[log_buffer])
 logger = logging.getLogger(__name__)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    # One client for every call in the process. Its connection pool keeps
+    # connections alive, so iterations skip the TCP+TLS handshake; the
+    # SDK's default pool limits already cover many concurrent agents.
+    # Fail a dead connection in 5s rather than the SDK's 10-minute default.
+    timeout=Timeout(30.0, connect=5.0)
+)
+
+# Reusable JSON codecs. json.dumps() with any non-default option builds a
+# fresh encoder per call; these are built once and shared by every call.
+_json_decoder = json.JSONDecoder()
+_compact_json = json.JSONEncoder(separators=(",", ":")).encode
+_canonical_json = json.JSONEncoder(sort_keys=True, default=str).encode
 
 
 # ============================================================================
@@ -58,36 +90,63 @@ class CircuitBreaker:
     
     # Internal state
     failures: Dict[str, int] = field(default_factory=dict)
-    opened_at: Dict[str, datetime] = field(default_factory=dict)
+    opened_at: Dict[str, float] = field(default_factory=dict)  # time.monotonic()
+    half_open_in_flight: Dict[str, bool] = field(default_factory=dict)  # Probe admitted
+    
+    # Concurrent tool calls share this breaker. Every read-modify-write
+    # goes through the lock, so failure counts aren't lost and only one
+    # caller wins the half-open probe.
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
     
     def record_success(self, service: str):
         """Service call succeeded - reset failure count"""
-        self.failures[service] = 0
-        if service in self.opened_at:
-            del self.opened_at[service]
-            logger.info(f"Circuit breaker CLOSED for {service}")
+        with self._lock:
+            self.failures[service] = 0
+            self.half_open_in_flight.pop(service, None)
+            if service in self.opened_at:
+                del self.opened_at[service]
+                logger.info(f"Circuit breaker CLOSED for {service}")
     
     def record_failure(self, service: str):
         """Service call failed - increment failure count"""
-        self.failures[service] = self.failures.get(service, 0) + 1
+        with self._lock:
+            self.failures[service] = self.failures.get(service, 0) + 1
+            self.half_open_in_flight.pop(service, None)
+            
+            # Also re-opens after a failed half-open probe: the count
+            # is still past the threshold
+            if self.failures[service] >= self.failure_threshold:
+                self.opened_at[service] = time.monotonic()
+                logger.warning(f"Circuit breaker OPENED for {service} after {self.failures[service]} failures")
+    
+    def release_probe(self, service: str):
+        """
+        Probe ended without a verdict (e.g. bad input) - let another in.
         
-        if self.failures[service] >= self.failure_threshold:
-            self.opened_at[service] = datetime.now()
-            logger.warning(f"Circuit breaker OPENED for {service} after {self.failures[service]} failures")
+        Without this, a probe that neither succeeds nor fails would hold
+        the half-open slot forever and the circuit would never close.
+        """
+        with self._lock:
+            self.half_open_in_flight.pop(service, None)
     
     def is_open(self, service: str) -> bool:
         """Check if circuit is open for this service"""
-        if service not in self.opened_at:
-            return False
-        
-        # Check if timeout has expired
-        if datetime.now() - self.opened_at[service] > timedelta(seconds=self.timeout_seconds):
-            logger.info(f"Circuit breaker entering HALF_OPEN for {service}")
-            # Enter half-open state (allow one test request)
-            del self.opened_at[service]
-            return False
-        
-        return True
+        with self._lock:
+            if service not in self.opened_at:
+                return False
+            
+            # Check if timeout has expired. Monotonic clock: cheap, and immune
+            # to wall-clock jumps (NTP, DST) that could hold a circuit open
+            if time.monotonic() - self.opened_at[service] > self.timeout_seconds:
+                # Half-open: admit exactly one test request. Everyone else
+                # keeps failing fast until it reports back - no stampede
+                # against a service that may still be down.
+                if not self.half_open_in_flight.get(service):
+                    self.half_open_in_flight[service] = True
+                    logger.info(f"Circuit breaker entering HALF_OPEN for {service}")
+                    return False
+            
+            return True
 
 
 # Global circuit breaker instance
@@ -108,23 +167,44 @@ class PermanentError(Exception):
     pass
 
 
+def _log_retries_exhausted(retry_state: RetryCallState) -> Any:
+    """Report the retry cost so backoff settings can be tuned, then re-raise"""
+    logger.error(
+        "%s gave up after %d attempts, %.2fs spent waiting between them",
+        retry_state.fn.__name__ if retry_state.fn else "call",
+        retry_state.attempt_number,
+        retry_state.idle_for
+    )
+    return retry_state.outcome.result()
+
+
 def smart_retry(func: Callable) -> Callable:
     """
     Decorator for retrying with exponential backoff and jitter.
     
     Retries on transient failures, fails fast on permanent errors.
-    Uses tenacity library for robust retry logic.
+    Uses tenacity library for robust retry logic. Works on coroutines:
+    backoff sleeps with asyncio.sleep, so other calls keep running.
     """
     return retry(
         # Only retry on specific exceptions
         retry=retry_if_exception_type(RetryableError),
-        # Stop after 3 attempts
-        stop=stop_after_attempt(3),
-        # Exponential backoff: 1s, 2s, 4s (with jitter)
-        wait=wait_exponential(multiplier=1, min=1, max=10),
+        # Whichever comes first: 10s in total (slow calls, e.g. timeouts)
+        # or one attempt short of the breaker threshold, so a single
+        # failing call can't trip the circuit for every other caller
+        stop=(
+            stop_after_delay(10)
+            | stop_after_attempt(circuit_breaker.failure_threshold - 1)
+        ),
+        # 250ms floor plus full-jitter exponential (random up to 250ms,
+        # 500ms, 1s, ... capped at 4s). A blip doesn't cost a full second,
+        # a rate limit isn't hammered within milliseconds, and concurrent
+        # retries don't synchronize.
+        wait=wait_fixed(0.25) + wait_random_exponential(multiplier=0.25, max=4),
         # Log before sleeping
         before_sleep=before_sleep_log(logger, logging.WARNING),
-        # Re-raise the last exception if all retries fail
+        # Log time spent backing off, then re-raise the last exception
+        retry_error_callback=_log_retries_exhausted,
         reraise=True
     )(func)
 
@@ -133,7 +213,19 @@ def smart_retry(func: Callable) -> Callable:
 # MOCK TOOLS - Simulate unreliable APIs
 # ============================================================================
 
-def unreliable_weather_api(city: str) -> Dict[str, Any]:
+# Failure dice for the mock tools. Each tool task gets its own generator
+# (see with_own_rng) instead of all of them sharing the global random
+# module state. The default covers calls made outside a tool task.
+_rng: ContextVar[random.Random] = ContextVar("_rng", default=random.Random())
+
+
+async def with_own_rng(awaitable: Awaitable[Any]) -> Any:
+    """Run awaitable with a freshly seeded generator for this task only"""
+    _rng.set(random.Random(os.urandom(8)))
+    return await awaitable
+
+
+async def unreliable_weather_api(city: str) -> Dict[str, Any]:
     """
     Mock weather API that fails 30% of the time.
     
@@ -146,7 +238,7 @@ def unreliable_weather_api(city: str) -> Dict[str, Any]:
     """
     
     # Simulate different types of failures
-    failure_type = random.random()
+    failure_type = _rng.get().random()
     
     if failure_type < 0.15:
         # Network timeout (should retry)
@@ -179,13 +271,13 @@ def unreliable_weather_api(city: str) -> Dict[str, Any]:
     return weather_data[city]
 
 
-def database_query(query: str) -> str:
+async def database_query(query: str) -> str:
     """
     Mock database that occasionally fails.
     
     Simulates connection pool exhaustion, deadlocks, etc.
     """
-    if random.random() < 0.2:
+    if _rng.get().random() < 0.2:
         logger.warning(f"Database connection failed")
         raise RetryableError("Database connection pool exhausted")
     
@@ -193,46 +285,96 @@ def database_query(query: str) -> str:
     return f"Database result for: {query}"
 
 
+# ============================================================================
+# TOOL RESULT CACHE - Don't pay for the same call twice
+# ============================================================================
+
+TOOL_CACHE_TTL_SECONDS = 300  # How long a successful result stays fresh
+TOOL_CACHE_MAX_ENTRIES = 1024  # Oldest results are dropped past this
+
+# key -> (stored_at, result), oldest store first - the first entry is
+# always the next to expire. Successful results only: errors are never
+# cached, so a transient failure can't be replayed as an answer.
+_tool_cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+
+def tool_cache_key(tool_name: str, arguments: Dict[str, Any]) -> str:
+    """Stable key for a call: same tool + same arguments = same key"""
+    canonical = _canonical_json({"tool": tool_name, "args": arguments})
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
 # ============================================================================
 # TOOL EXECUTOR - Wrap all tools with retry logic
 # ============================================================================
 
 @smart_retry
-def execute_tool_with_retry(tool_name: str, arguments: Dict[str, Any]) -> str:
+async def execute_tool_with_retry(
+    tool_name: str,
+    arguments: Dict[str, Any],
+    use_cache: bool = True
+) -> str:
     """
     Execute a tool with automatic retry logic.
     
     This wraps all tool calls with:
-    1. Circuit breaker check
-    2. Retry logic for transient failures
-    3. Error handling and logging
+    1. Result cache check (repeat calls skip the network)
+    2. Argument validation against the tool's schema
+    3. Circuit breaker check
+    4. Retry logic for transient failures
+    5. Error handling and logging
     """
     
+    # A batch result mixes per-city outcomes, errors included, and each
+    # city is already cached on its own - never cache the batch itself
+    use_cache = use_cache and tool_name != "get_weather_batch"
+    
+    if use_cache:
+        key = tool_cache_key(tool_name, arguments)
+        cached = _tool_cache.get(key)
+        if cached:
+            if time.monotonic() - cached[0] < TOOL_CACHE_TTL_SECONDS:
+                logger.info(f"Cache hit for {tool_name}")
+                return cached[1]
+            del _tool_cache[key]  # Expired - don't keep dead entries around
+    
+    # Malformed arguments from the model fail here, before they can take
+    # a circuit breaker probe or cost a network round-trip. Same result
+    # as any other permanent error: an error string the model can fix.
+    validate = _VALIDATORS.get(tool_name)
+    error = validate(arguments) if validate else None
+    if error:
+        logger.error(f"Invalid arguments for {tool_name}: {error}")
+        return f"Error: Invalid arguments for {tool_name}: {error}"
+    
     # Check circuit breaker first - don't waste time on dead services
     if circuit_breaker.is_open(tool_name):
         logger.warning(f"Circuit breaker OPEN for {tool_name}, failing fast")
         raise PermanentError(f"{tool_name} is currently unavailable, please try again later")
     
-    # Tool registry
-    tools = {
-        "get_weather": unreliable_weather_api,
-        "query_database": database_query,
-    }
-    
-    if tool_name not in tools:
+    func = _TOOL_REGISTRY.get(tool_name)
+    if func is None:
         raise PermanentError(f"Unknown tool: {tool_name}")
     
     try:
         # Execute the tool
-        result = tools[tool_name](**arguments)
+        result = await func(**arguments)
         
         # Success - reset circuit breaker
         circuit_breaker.record_success(tool_name)
         
-        # Convert dict to JSON for consistency
+        # Convert dict to compact JSON - whitespace is billed tokens
         if isinstance(result, dict):
-            return json.dumps(result, indent=2)
-        return str(result)
+            output = _compact_json(result)
+        else:
+            output = str(result)
+        
+        if use_cache:
+            _tool_cache[key] = (time.monotonic(), output)
+            _tool_cache.move_to_end(key)
+            if len(_tool_cache) > TOOL_CACHE_MAX_ENTRIES:
+                _tool_cache.popitem(last=False)
+        return output
         
     except RetryableError as e:
         # Transient failure - will be retried by decorator
@@ -242,20 +384,71 @@ def execute_tool_with_retry(tool_name: str, arguments: Dict[str, Any]) -> str:
         
     except PermanentError as e:
         # Permanent failure - don't retry
+        circuit_breaker.release_probe(tool_name)
         logger.error(f"Permanent error in {tool_name}: {e}")
         return f"Error: {str(e)}"
         
     except Exception as e:
         # Unknown error - treat as permanent (fail safe)
+        circuit_breaker.release_probe(tool_name)
         logger.error(f"Unexpected error in {tool_name}: {e}")
         return f"Unexpected error: {str(e)}"
+        
+    except BaseException:
+        # Cancelled mid-call (e.g. the stream failed and cancelled this
+        # task). No verdict either way - hand back the half-open slot,
+        # or the circuit would stay open for the rest of the process.
+        circuit_breaker.release_probe(tool_name)
+        raise
+
+
+# Settings of the tool call in progress. Tools only receive the model's
+# arguments, so run_tool_call puts these in the task's context for tools
+# that make nested calls (weather_batch).
+_use_tool_cache: ContextVar[bool] = ContextVar("_use_tool_cache", default=True)
+_max_fanout: ContextVar[int] = ContextVar("_max_fanout", default=10)
+
+
+async def weather_batch(cities: List[str]) -> str:
+    """
+    Weather for several cities in one tool call.
+    
+    One call from the model instead of one per city: fewer LLM turns,
+    and the per-city lookups fan out concurrently - at most the agent's
+    max_concurrent_tools at once, so a long city list can't stampede
+    the API. Each city still goes through execute_tool_with_retry, so it
+    gets its own retries, cache entry (unless caching is off for this
+    call), and circuit breaker accounting - one bad city doesn't fail
+    the batch.
+    """
+    use_cache = _use_tool_cache.get()
+    semaphore = asyncio.Semaphore(_max_fanout.get())
+    
+    async def fetch(city: str) -> str:
+        async with semaphore:
+            return await with_own_rng(execute_tool_with_retry("get_weather", {"city": city}, use_cache))
+    
+    results = await asyncio.gather(*(fetch(city) for city in cities), return_exceptions=True)
+    return "\n".join(
+        f"{city}: Error: {result} (all retries exhausted)" if isinstance(result, Exception)
+        else f"{city}: {result}"
+        for city, result in zip(cities, results)
+    )
+
+
+# Tool registry. Built once at import, not on every call and retry.
+_TOOL_REGISTRY: Dict[str, Callable[..., Awaitable[Any]]] = {
+    "get_weather": unreliable_weather_api,
+    "query_database": database_query,
+    "get_weather_batch": weather_batch,
+}
 
 
 # ============================================================================
 # AGENT LOGIC
 # ============================================================================
 
-TOOLS = [
+TOOLS: List[ChatCompletionToolParam] = [
     {
         "type": "function",
         "function": {
@@ -270,6 +463,24 @@ TOOLS = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_weather_batch",
+            "description": "Get current weather for several cities in one call. May be temporarily unavailable.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "cities": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "City names"
+                    }
+                },
+                "required": ["cities"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -287,12 +498,375 @@ TOOLS = [
 ]
 
 
-def robust_agent(task: str, max_iterations: int = 10) -> str:
+# ============================================================================
+# ARGUMENT VALIDATION - Reject malformed tool calls before they cost anything
+# ============================================================================
+
+_JSON_TYPES: Dict[str, Any] = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "array": list,
+    "object": dict,
+}
+
+
+def compile_validator(schema: Dict[str, Any], path: str = "arguments") -> Callable[[Any], Optional[str]]:
+    """
+    Turn a JSON schema into a checker, once.
+    
+    Covers what tool schemas actually use: type, required, properties,
+    items. The checker returns an error message, or None if the value
+    fits. Swap in a full JSON Schema library if your schemas outgrow this.
+    """
+    type_name = schema.get("type")
+    expected = _JSON_TYPES.get(type_name)
+    required = tuple(schema.get("required", ()))
+    properties = {
+        name: compile_validator(sub, f"{path}.{name}")
+        for name, sub in schema.get("properties", {}).items()
+    }
+    items = compile_validator(schema["items"], f"{path}[]") if "items" in schema else None
+    
+    def validate(value: Any) -> Optional[str]:
+        # bool is an int subclass in Python, but not a number in JSON
+        if expected is not None and (
+            not isinstance(value, expected)
+            or (isinstance(value, bool) and type_name != "boolean")
+        ):
+            return f"{path} must be {type_name}, got {type(value).__name__}"
+        if isinstance(value, dict):
+            for name in required:
+                if name not in value:
+                    return f"{path} is missing required '{name}'"
+            for name, check in properties.items():
+                if name in value:
+                    error = check(value[name])
+                    if error:
+                        return error
+        if items is not None and isinstance(value, list):
+            for item in value:
+                error = items(item)
+                if error:
+                    return error
+        return None
+    
+    return validate
+
+
+# Tool name -> argument checker, compiled from TOOLS at import
+_VALIDATORS: Dict[str, Callable[[Any], Optional[str]]] = {
+    tool["function"]["name"]: compile_validator(tool["function"]["parameters"])
+    for tool in TOOLS
+}
+
+
+# ============================================================================
+# STREAMING + LLM RESPONSE CACHE - Start tools while the model is still talking
+# ============================================================================
+
+LLM_CACHE_MAX_ENTRIES = 256  # Least recently used entries go first
+
+# Request hash -> (assistant message, tokens it cost), oldest use first.
+# Process-local: swap in Redis or a disk cache if runs should share hits.
+_llm_cache: "OrderedDict[str, Tuple[Dict[str, Any], int]]" = OrderedDict()
+
+# Everything in a request except the messages. Fixed for the whole run,
+# so serialize and hash it once; each call only hashes its messages.
+_REQUEST_OPTIONS: Dict[str, Any] = {
+    "model": "gpt-4o-mini",
+    "tools": TOOLS,
+    "tool_choice": "auto",
+}
+_REQUEST_OPTIONS_HASH = hashlib.sha256(_canonical_json(_REQUEST_OPTIONS).encode())
+
+
+def _complete_arguments(buffer: str) -> Optional[Dict[str, Any]]:
+    """Parsed tool arguments if the streamed JSON object is complete, else None"""
+    try:
+        args, _ = _json_decoder.raw_decode(buffer.lstrip())
+    except json.JSONDecodeError:
+        return None
+    return args if isinstance(args, dict) else None
+
+
+def _parse_arguments(raw: str) -> Dict[str, Any]:
+    """Parse a finished arguments string - the model may send "" for no arguments"""
+    return json.loads(raw or "{}")
+
+
+async def stream_chat_completion(
+    messages: List[Dict[str, Any]],
+    dispatch: Callable[[str, Dict[str, Any]], Awaitable[str]],
+    use_cache: bool = True
+) -> Tuple[Dict[str, Any], List["asyncio.Task[str]"]]:
+    """
+    Run one model turn, starting each tool call the moment it's complete.
+    
+    A blocking call waits for the whole completion before any tool runs.
+    Streaming lets the first tool call's network round-trip overlap with
+    the model still generating the second one.
+    
+    Identical requests (model, messages, tools, tool_choice) replay from
+    cache instead of re-billing and re-waiting for every step, unless
+    use_cache is off. The cache keeps the LLM_CACHE_MAX_ENTRIES most
+    recently used responses.
+    
+    Returns the assistant message, ready to append to history, and one
+    task per tool call in call order.
+    """
+    key = None
+    if use_cache:
+        hasher = _REQUEST_OPTIONS_HASH.copy()
+        hasher.update(_canonical_json(messages).encode())
+        key = hasher.hexdigest()
+    
+    cached = _llm_cache.get(key) if key else None
+    if cached is not None:
+        _llm_cache.move_to_end(key)
+        message, tokens = cached
+        logger.info(f"LLM cache hit - saved {tokens} tokens")
+        # Parse every call before starting any, so a bad one can't strand
+        # tasks already created for the others
+        parsed = [
+            (tc["function"]["name"], _parse_arguments(tc["function"]["arguments"]))
+            for tc in message.get("tool_calls", [])
+        ]
+        return message, [asyncio.create_task(dispatch(name, args)) for name, args in parsed]
+    
+    content_parts: List[str] = []
+    calls: Dict[int, Dict[str, Any]] = {}  # Stream index -> tool call, wire format
+    tasks_by_index: Dict[int, "asyncio.Task[str]"] = {}
+    usage = None
+    
+    try:
+        stream = await client.chat.completions.create(
+            **_REQUEST_OPTIONS,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        async for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage  # Final chunk, no choices
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            
+            if delta.content:
+                content_parts.append(delta.content)
+            
+            for tc in delta.tool_calls or []:
+                call = calls.setdefault(tc.index, {
+                    "id": "",
+                    "type": "function",
+                    "function": {"name": "", "arguments": ""}
+                })
+                if tc.id:
+                    call["id"] = tc.id
+                if tc.function and tc.function.name:
+                    call["function"]["name"] += tc.function.name
+                if tc.function and tc.function.arguments:
+                    call["function"]["arguments"] += tc.function.arguments
+                
+                # Dispatch as soon as the arguments parse as a full object
+                if tc.index not in tasks_by_index:
+                    args = _complete_arguments(call["function"]["arguments"])
+                    if args is not None:
+                        tasks_by_index[tc.index] = asyncio.create_task(
+                            dispatch(call["function"]["name"], args)
+                        )
+        
+        # Anything the incremental check missed (e.g. empty arguments)
+        for index, call in calls.items():
+            if index not in tasks_by_index:
+                args = _parse_arguments(call["function"]["arguments"])
+                tasks_by_index[index] = asyncio.create_task(dispatch(call["function"]["name"], args))
+    except BaseException:
+        # Don't leave tools running for a turn that never completed
+        for task in tasks_by_index.values():
+            task.cancel()
+        raise
+    
+    message: Dict[str, Any] = {"role": "assistant", "content": "".join(content_parts) or None}
+    if calls:
+        message["tool_calls"] = [calls[i] for i in sorted(calls)]
+    
+    if usage:
+        if key:
+            _llm_cache[key] = (message, usage.total_tokens)
+            _llm_cache.move_to_end(key)
+            if len(_llm_cache) > LLM_CACHE_MAX_ENTRIES:
+                _llm_cache.popitem(last=False)
+        
+        # Confirm the stable prefix is being reused by OpenAI's prompt cache
+        details = usage.prompt_tokens_details
+        if details and details.cached_tokens:
+            logger.info(f"Prompt cache: {details.cached_tokens}/{usage.prompt_tokens} input tokens cached")
+    
+    return message, [tasks_by_index[i] for i in sorted(tasks_by_index)]
+
+
+# ============================================================================
+# HISTORY COMPACTION - Bound per-iteration prompt size
+# ============================================================================
+
+@functools.lru_cache(maxsize=1)
+def _get_encoding() -> tiktoken.Encoding:
+    """Build the tokenizer once - construction is the expensive part"""
+    try:
+        return tiktoken.encoding_for_model("gpt-4o-mini")
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")  # Older tiktoken
+
+
+@functools.lru_cache(maxsize=4096)
+def _count_tokens(text: str) -> int:
+    """Token count per string, memoized - history is re-measured every iteration"""
+    return len(_get_encoding().encode(text))
+
+
+def _message_tokens(msg: Dict[str, Any]) -> int:
+    """Approximate tokens for one message, including tool call arguments"""
+    tokens = 4  # Role and formatting overhead
+    if msg.get("content"):
+        tokens += _count_tokens(msg["content"])
+    for tc in msg.get("tool_calls", []):
+        tokens += _count_tokens(tc["function"]["name"]) + _count_tokens(tc["function"]["arguments"])
+    return tokens
+
+
+def compact_messages(messages: List[Dict[str, Any]], max_tokens: int = 4096) -> List[Dict[str, Any]]:
+    """
+    Keep the prompt under max_tokens by folding old tool rounds into a summary.
+    
+    Every iteration resends the whole history, so total tokens sent over a
+    run grow quadratically. Once over budget:
+    - Keep the system prompt and the original task
+    - Keep the most recent tool rounds (assistant call + its results) that fit
+    - Fold older rounds into one "Prior tool results summary" message
+    
+    Rounds are never split - the API rejects tool results whose call is gone.
+    Under budget, history is returned untouched so the prompt prefix stays
+    stable for prompt caching.
+    """
+    if sum(_message_tokens(m) for m in messages) <= max_tokens:
+        return messages
+    
+    head, body = messages[:2], messages[2:]
+    
+    # Carry forward the summary from an earlier compaction
+    summary_lines = []
+    if body and body[0]["role"] == "system":
+        summary_lines = body[0]["content"].splitlines()[1:]
+        body = body[1:]
+    
+    # Group into rounds: an assistant message and the tool results after it
+    rounds: List[List[Dict[str, Any]]] = []
+    for msg in body:
+        if msg["role"] == "tool" and rounds:
+            rounds[-1].append(msg)
+        else:
+            rounds.append([msg])
+    
+    # A quarter of the budget for the summary, the rest for recent rounds
+    summary_budget = max_tokens // 4
+    
+    # Newest rounds first, while they fit. The latest always stays.
+    budget = max_tokens - sum(_message_tokens(m) for m in head) - summary_budget
+    kept: List[List[Dict[str, Any]]] = []
+    for rnd in reversed(rounds):
+        cost = sum(_message_tokens(m) for m in rnd)
+        if kept and cost > budget:
+            break
+        kept.insert(0, rnd)
+        budget -= cost
+    
+    # One line per folded tool result, truncated
+    for rnd in rounds[:len(rounds) - len(kept)]:
+        calls = {tc["id"]: tc["function"] for tc in rnd[0].get("tool_calls", [])}
+        for msg in rnd[1:]:
+            fn = calls.get(msg["tool_call_id"], {"name": "tool", "arguments": ""})
+            summary_lines.append(f"- {fn['name']}({fn['arguments']}) -> {msg['content'][:200]}")
+    
+    # The summary is bounded too: newest lines win, the oldest drop off
+    recent_lines = []
+    for line in reversed(summary_lines):
+        summary_budget -= _count_tokens(line)
+        if summary_budget < 0:
+            break
+        recent_lines.append(line)
+    summary_lines = recent_lines[::-1]
+    
+    summary = {
+        "role": "system",
+        "content": "Prior tool results summary:\n" + "\n".join(summary_lines)
+    }
+    return head + [summary] + [m for rnd in kept for m in rnd]
+
+
+# Iteration banner, built once. One log record per iteration, not three.
+_ITERATION_HEADER = "\n" + "=" * 60 + "\nIteration %d/%d\n" + "=" * 60
+
+
+async def run_tool_call(
+    tool_name: str,
+    tool_args: Dict[str, Any],
+    semaphore: asyncio.Semaphore,
+    use_cache: bool = True,
+    max_fanout: int = 10
+) -> str:
+    """
+    Execute one tool call with retries, bounded by the shared semaphore.
+    
+    use_cache and max_fanout also apply to calls the tool makes itself
+    (get_weather_batch's per-city lookups).
+    
+    Never raises: exhausted retries become an error string for the model.
+    """
+    logger.info("🔧 Calling %s(%s)", tool_name, tool_args)
+    
+    # Runs as its own task (context copied at creation), so these stay
+    # local to this call
+    _use_tool_cache.set(use_cache)
+    _max_fanout.set(max_fanout)
+    
+    # Execute with retry logic
+    try:
+        async with semaphore:
+            result = await with_own_rng(execute_tool_with_retry(tool_name, tool_args, use_cache))
+        logger.info("✅ Success: %s", result)
+    except Exception as e:
+        # All retries exhausted
+        result = f"Error: {str(e)} (all retries exhausted)"
+        logger.info("❌ Failed: %s", result)
+    
+    return result
+
+
+async def robust_agent(
+    task: str,
+    max_iterations: int = 10,
+    max_concurrent_tools: int = 10,
+    cache_tool_calls: bool = True,
+    max_context_tokens: int = 4096,
+    cache_llm_calls: bool = True
+) -> str:
     """
     Agent with production-grade error handling.
     
     Handles tool failures gracefully and can complete tasks even when
-    some tools are unavailable.
+    some tools are unavailable. Tool calls from one response run
+    concurrently, up to max_concurrent_tools at a time.
+    
+    With cache_tool_calls, a repeated call (same tool, same arguments)
+    within TOOL_CACHE_TTL_SECONDS reuses the earlier successful result.
+    Turn it off for tools whose answers must always be live.
+    cache_llm_calls does the same for identical model requests.
+    
+    History past max_context_tokens has its older tool rounds folded
+    into a summary (see compact_messages).
     """
     
     system_prompt = """You are a resilient AI agent that handles tool failures gracefully.
@@ -302,68 +876,52 @@ When a tool fails:
 2. Try alternative approaches if available
 3. If a tool is unavailable, work around it or inform the user
 
+When asked about multiple cities, call get_weather_batch once rather than get_weather multiple times.
+
 Be helpful even when tools fail. Don't give up after one failure."""
 
+    # Append-only history keeps the prompt prefix byte-identical across
+    # iterations, so OpenAI's automatic prompt caching can reuse it -
+    # until compact_messages first rewrites older rounds past the budget
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": task}
     ]
     
+    # Bounds tool fan-out so retries can't stampede a struggling API
+    semaphore = asyncio.Semaphore(max_concurrent_tools)
+    
     for iteration in range(max_iterations):
-        print(f"\n{'='*60}")
-        print(f"Iteration {iteration + 1}/{max_iterations}")
-        print(f"{'='*60}")
+        logger.info(_ITERATION_HEADER, iteration + 1, max_iterations)
         
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            tools=TOOLS,
-            tool_choice="auto"
+        # Tool calls start executing while the response streams in
+        message, tool_tasks = await stream_chat_completion(
+            messages,
+            lambda name, args: run_tool_call(
+                name, args, semaphore, cache_tool_calls, max_concurrent_tools
+            ),
+            cache_llm_calls
         )
         
-        message = response.choices[0].message
-        
-        if message.tool_calls:
-            messages.append({
-                "role": "assistant",
-                "content": message.content,
-                "tool_calls": [
-                    {
-                        "id": tc.id,
-                        "type": "function",
-                        "function": {
-                            "name": tc.function.name,
-                            "arguments": tc.function.arguments
-                        }
-                    }
-                    for tc in message.tool_calls
-                ]
-            })
+        if tool_tasks:
+            # Already in wire format - assembled once from the stream
+            messages.append(message)
             
-            for tool_call in message.tool_calls:
-                tool_name = tool_call.function.name
-                tool_args = json.loads(tool_call.function.arguments)
-                
-                print(f"\n🔧 Calling {tool_name}({tool_args})")
-                
-                # Execute with retry logic
-                try:
-                    result = execute_tool_with_retry(tool_name, tool_args)
-                    print(f"✅ Success: {result}")
-                except Exception as e:
-                    # All retries exhausted
-                    result = f"Error: {str(e)} (all retries exhausted)"
-                    print(f"❌ Failed: {result}")
-                
+            # Independent calls run concurrently - one slow or retrying
+            # tool no longer holds up the others
+            results = await asyncio.gather(*tool_tasks)
+            
+            for tool_call, result in zip(message["tool_calls"], results):
                 messages.append({
                     "role": "tool",
                     "content": result,
-                    "tool_call_id": tool_call.id
+                    "tool_call_id": tool_call["id"]
                 })
+            
+            messages = compact_messages(messages, max_context_tokens)
         else:
-            print(f"\n✅ Final answer:")
-            print(message.content)
-            return message.content
+            logger.info("✅ Final answer: %s", message["content"])
+            return message["content"]
     
     return f"Error: Task not completed within {max_iterations} iterations"
 
@@ -381,8 +939,10 @@ if __name__ == "__main__":
     print(f"\nTask: {task}\n")
     print("Note: Tools will fail randomly to demonstrate retry logic\n")
     
-    result = robust_agent(task)
+    result = asyncio.run(robust_agent(task))
+    log_buffer.flush()
     
     print("\n" + "="*60)
     print("COMPLETED")
     print("="*60)
+    print(result)